@@ -457,3 +457,44 @@ export const deductCreditsForAgent = mutation({
     },
 });
 
+/**
+ * Refund comprehensive credits (for agent API) - returns a reservation
+ * that was deducted for a run that failed or was cancelled
+ */
+export const refundCreditsForAgent = mutation({
+    args: {
+        userId: v.string(),
+        email: v.optional(v.string()),
+        amount: v.number(),
+    },
+    handler: async (ctx, args) => {
+        // Find profile by userId first
+        let profile = await ctx.db
+            .query("profiles")
+            .withIndex("by_user", (q) => q.eq("userId", args.userId))
+            .unique();
+
+        // If not found and email provided, try by email
+        if (!profile && args.email) {
+            profile = await ctx.db
+                .query("profiles")
+                .withIndex("by_email", (q) => q.eq("email", args.email!.toLowerCase()))
+                .unique();
+        }
+
+        if (!profile) {
+            return { success: false, error: "User not found" };
+        }
+
+        const currentCredits = profile.comprehensive_credits_remaining ?? 0;
+        await ctx.db.patch(profile._id, {
+            comprehensive_credits_remaining: currentCredits + args.amount,
+            updated_at: new Date().toISOString(),
+        });
+
+        return {
+            success: true,
+            credits_remaining: currentCredits + args.amount,
+        };
+    },
+});
@@ -2,6 +2,7 @@ import { NextRequest, NextResponse } from 'next/server';
 // import { createClient } from '@/lib/supabase/server';
 
 const AGENT_URL = process.env.AGENT_URL || 'http://localhost:8001';
+const AGENT_SECRET = process.env.AGENT_SECRET || 'eloquo-agent-internal-key';
 
 export async function GET(request: NextRequest) {
     try {
@@ -50,6 +51,7 @@ export async function GET(request: NextRequest) {
             method: 'GET',
             headers: {
                 'Content-Type': 'application/json',
+                'Authorization': `Bearer ${AGENT_SECRET}`,
             },
             // Short timeout for agent
             signal: AbortSignal.timeout(10000),
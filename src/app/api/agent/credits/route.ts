@@ -46,8 +46,8 @@ export async function POST(request: NextRequest) {
                 userId: credits.userId,  // Return actual userId for deduct call
             });
 
-        } else if (action === "deduct") {
-            // Deduct credits
+        } else if (action === "deduct" || action === "reserve") {
+            // Deduct credits - atomic check-and-deduct, so "reserve" needs no prior "check"
             if (!amount || amount <= 0) {
                 return NextResponse.json({ error: "Valid amount required" }, { status: 400 });
             }
@@ -70,9 +70,30 @@ export async function POST(request: NextRequest) {
                 credits_remaining: result.credits_remaining,
             });
 
+        } else if (action === "refund") {
+            // Refund a reservation for a failed or cancelled run
+            if (!amount || amount <= 0) {
+                return NextResponse.json({ error: "Valid amount required" }, { status: 400 });
+            }
+
+            const result = await convex.mutation(api.profiles.refundCreditsForAgent, {
+                userId: user_id,
+                email: email || undefined,
+                amount: amount,
+            });
+
+            if (!result.success) {
+                return NextResponse.json({ error: result.error }, { status: 404 });
+            }
+
+            return NextResponse.json({
+                success: true,
+                credits_remaining: result.credits_remaining,
+            });
+
         } else {
             return NextResponse.json({
-                error: "Invalid action. Use 'check' or 'deduct'"
+                error: "Invalid action. Use 'check', 'reserve', 'deduct' or 'refund'"
             }, { status: 400 });
         }
 
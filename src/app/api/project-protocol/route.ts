@@ -5,6 +5,7 @@ import { api } from "../../../../convex/_generated/api";
 
 const convex = new ConvexHttpClient(process.env.NEXT_PUBLIC_CONVEX_URL!);
 const AGENT_URL = process.env.AGENT_URL || "http://localhost:8001";
+const AGENT_SECRET = process.env.AGENT_SECRET || "eloquo-agent-internal-key";
 
 export async function POST(request: NextRequest) {
     try {
@@ -51,7 +52,8 @@ export async function POST(request: NextRequest) {
 
         const agentResponse = await fetch(`${AGENT_URL}/project-protocol`, {
             method: "POST",
-            headers: { "Content-Type": "application/json" },
+            // The agent rate-limits by user_id and user_tier only for callers with its secret
+            headers: { "Content-Type": "application/json", "Authorization": `Bearer ${AGENT_SECRET}` },
             body: JSON.stringify({
                 project_idea: projectIdea,
                 project_type: projectType || "saas",
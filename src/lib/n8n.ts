@@ -7,6 +7,16 @@
  */
 
 const AGENT_URL = process.env.AGENT_URL || 'http://localhost:8001';
+const AGENT_SECRET = process.env.AGENT_SECRET || 'eloquo-agent-internal-key';
+
+// The agent only trusts the user id and tier of callers that send its secret
+function agentHeaders(userId?: string): Record<string, string> {
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${AGENT_SECRET}`,
+        ...(userId ? { 'X-User-Id': userId } : {}),
+    };
+}
 
 // Types for requests and responses (unchanged from original)
 export interface ContextFile {
@@ -279,7 +289,8 @@ export async function callOptimize(request: OptimizeRequest): Promise<OptimizeRe
 
         const response = await fetch(`${AGENT_URL}/optimize`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            // Per-user rate limits on the agent; without a user all calls share this server's limits
+            headers: agentHeaders(request.userId),
             body: JSON.stringify(v3Request),
             signal: controller.signal,
         });
@@ -356,7 +367,7 @@ export async function callAnalyze(prompt: string): Promise<AnalyzeResponse> {
     try {
         const response = await fetch(`${AGENT_URL}/optimize`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: agentHeaders(),
             body: JSON.stringify({
                 prompt: prompt,
                 user_tier: 'free',
@@ -406,7 +417,7 @@ export async function callRefine(request: RefineRequest): Promise<RefineResponse
     try {
         const response = await fetch(`${AGENT_URL}/refine`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: agentHeaders(),
             body: JSON.stringify({
                 original_prompt: request.originalPrompt,
                 instruction: request.instruction,
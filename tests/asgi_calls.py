@@ -0,0 +1,57 @@
+"""Test support: call the app over raw ASGI, with a client that can go away mid-request."""
+
+import asyncio
+import json
+from typing import Optional
+
+import agent_v3
+
+
+class Sent:
+    """What the app sent back."""
+
+    def __init__(self, messages: list[dict]):
+        self.messages = messages
+        start = next(message for message in messages if message["type"] == "http.response.start")
+        self.status = start["status"]
+        self.headers = {key.decode().lower(): value.decode() for key, value in start.get("headers", [])}
+        self.body = b"".join(message.get("body", b"") for message in messages
+                             if message["type"] == "http.response.body")
+
+    def json(self):
+        return json.loads(self.body)
+
+
+async def call_app(path: str, body: dict, headers: Optional[dict] = None, client: str = "203.0.113.9",
+                   disconnect_after: Optional[float] = None) -> Sent:
+    """POST ``body`` as JSON; the client is reported gone ``disconnect_after`` seconds in."""
+    payload = json.dumps(body).encode()
+    gone = asyncio.Event()
+    messages = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    raw_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]
+    raw_headers += [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()]
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "headers": raw_headers, "client": (client, 40000), "server": ("testserver", 80),
+    }
+    if disconnect_after is not None:
+        asyncio.get_running_loop().call_later(disconnect_after, gone.set)
+    try:
+        await agent_v3.app(scope, receive, send)
+    finally:
+        gone.set()
+    return Sent(messages)
@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Keep tests off the network and the shared /dev/shm cache
+os.environ.setdefault("OPENROUTER_API_KEY", "test-key")
+os.environ.setdefault("CACHE_BACKEND", "memory")
+os.environ.setdefault("WARMUP_ENABLED", "false")
+os.environ.setdefault("RATE_LIMIT_BACKEND", "local")
@@ -0,0 +1,76 @@
+"""Test support: an in-memory stand-in for the OpenRouter chat completions API."""
+
+import asyncio
+import json
+import time
+
+import httpx
+
+
+def split_chunks(text: str, size: int = 24) -> list[str]:
+    """``text`` as the content deltas of a streamed completion."""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class SSEStream(httpx.AsyncByteStream):
+    """A text/event-stream body, one content delta every ``delay`` seconds."""
+
+    def __init__(self, stand_in: "OpenRouterStandIn", chunks: list[str], delay: float):
+        self.stand_in = stand_in
+        self.chunks = chunks
+        self.delay = delay
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            self.stand_in.record("delta")
+            yield b"data: " + json.dumps({"choices": [{"delta": {"content": chunk}}]}).encode() + b"\n\n"
+        usage = {"total_tokens": 300, "prompt_tokens": 100, "completion_tokens": 200}
+        yield b"data: " + json.dumps({"choices": [{"delta": {}, "finish_reason": "stop"}],
+                                      "usage": usage}).encode() + b"\n\n"
+        yield b"data: [DONE]\n\n"
+        self.stand_in.record("stream_finished")
+
+    async def aclose(self):
+        self.stand_in.record("stream_closed")
+
+
+class OpenRouterStandIn:
+    """
+    Streaming calls get ``stream_chunks`` as SSE deltas ``chunk_delay`` seconds
+    apart; other calls get ``reply`` after ``reply_delay`` seconds. What
+    happened, and when, goes into ``events``.
+    """
+
+    def __init__(self, stream_chunks: list[str], reply: str = "# Document", chunk_delay: float = 0.02,
+                 reply_delay: float = 0.0):
+        self.stream_chunks = stream_chunks
+        self.reply = reply
+        self.chunk_delay = chunk_delay
+        self.reply_delay = reply_delay
+        self.started = time.perf_counter()
+        self.events: list[tuple[float, str]] = []
+
+    def record(self, event: str):
+        self.events.append((time.perf_counter() - self.started, event))
+
+    def times(self, event: str) -> list[float]:
+        return [at for at, name in self.events if name == event]
+
+    def count(self, event: str) -> int:
+        return len(self.times(event))
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/api/v1/chat/completions"
+        body = json.loads(request.content)
+        if body.get("stream"):
+            self.record("stream_opened")
+            return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                                  stream=SSEStream(self, self.stream_chunks, self.chunk_delay))
+        self.record("completion_started")
+        await asyncio.sleep(self.reply_delay)
+        self.record("completion_finished")
+        return httpx.Response(200, json={
+            "choices": [{"message": {"content": self.reply}, "finish_reason": "stop"}],
+            "usage": {"total_tokens": 500, "prompt_tokens": 200, "completion_tokens": 300},
+        })
@@ -0,0 +1,113 @@
+"""Test support: an in-process stand-in for a Redis-protocol server."""
+
+import asyncio
+import fnmatch
+import time
+from typing import Any, Optional
+
+from agent_v3 import RespError, resp_read
+
+
+class RespStandIn:
+    """
+    Minimal in-process Redis-protocol server (GET, SET with PX/NX, DEL, SCAN,
+    PING, AUTH, SELECT, DBSIZE, FLUSHDB) for exercising RedisBackend without a
+    Redis install:
+
+        stand_in = RespStandIn()
+        server = await stand_in.start()
+        backend = RedisBackend(f"redis://127.0.0.1:{stand_in.port}/0")
+
+    With a ``password``, connections must AUTH before anything else; AUTH is
+    answered after ``auth_delay`` seconds.
+    ``connections`` and ``disconnects`` count clients that came and went.
+    """
+
+    def __init__(self, password: Optional[str] = None, auth_delay: float = 0.0):
+        self.password = password
+        self.auth_delay = auth_delay
+        self.data: dict[bytes, tuple[bytes, Optional[float]]] = {}
+        self.port: Optional[int] = None
+        self.connections = 0
+        self.disconnects = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self._serve, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        return server
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        authed = self.password is None
+        try:
+            while True:
+                args = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in await resp_read(reader)]
+                try:
+                    if args[0].upper() == b"AUTH":
+                        await asyncio.sleep(self.auth_delay)
+                        authed = self.password is None or args[-1] == self.password.encode()
+                        if not authed:
+                            raise RespError("WRONGPASS invalid username-password pair")
+                    elif not authed:
+                        raise RespError("NOAUTH Authentication required")
+                    reply = self.execute(args)
+                except RespError as e:
+                    writer.write(b"-%s\r\n" % str(e).encode())
+                else:
+                    writer.write(self._encode(reply))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.disconnects += 1
+        finally:
+            writer.close()
+
+    @classmethod
+    def _encode(cls, value: Any) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, bytes):
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+        return b"*%d\r\n" % len(value) + b"".join(cls._encode(item) for item in value)
+
+    def _live(self, key: bytes) -> Optional[bytes]:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return item[0]
+
+    def execute(self, args: list[bytes]) -> Any:
+        command, args = args[0].upper().decode(), args[1:]
+        if command == "PING":
+            return "PONG"
+        if command in ("AUTH", "SELECT"):
+            return "OK"
+        if command == "GET":
+            return self._live(args[0])
+        if command == "SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            if b"NX" in options and self._live(key) is not None:
+                return None
+            expires = None
+            if b"PX" in options:
+                expires = time.monotonic() + int(options[options.index(b"PX") + 1]) / 1000
+            self.data[key] = (value, expires)
+            return "OK"
+        if command == "DEL":
+            return sum(self.data.pop(key, None) is not None for key in args)
+        if command == "SCAN":
+            pattern = args[args.index(b"MATCH") + 1].decode() if b"MATCH" in args else "*"
+            return [b"0", [key for key in list(self.data)
+                           if fnmatch.fnmatchcase(key.decode(), pattern) and self._live(key) is not None]]
+        if command == "DBSIZE":
+            return len(self.data)
+        if command == "FLUSHDB":
+            self.data.clear()
+            return "OK"
+        raise RespError(f"ERR unknown command '{command}'")
@@ -0,0 +1,23 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import agent_v3
+
+SECRET = "Bearer eloquo-agent-internal-key"
+
+
+@pytest.fixture
+def client():
+    return TestClient(agent_v3.app)
+
+
+@pytest.mark.parametrize("path", ["/admin/metrics", "/admin/config", "/admin/routing", "/admin/profile/requests"])
+def test_admin_routes_need_the_internal_secret(client, path):
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+
+def test_metrics_with_the_internal_secret(client):
+    response = client.get("/admin/metrics", headers={"Authorization": SECRET})
+    assert response.status_code == 200
+    assert "credits" in response.json()
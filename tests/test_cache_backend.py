@@ -0,0 +1,157 @@
+import asyncio
+import threading
+
+import pytest
+from pydantic import BaseModel
+
+import agent_v3
+from agent_v3 import CacheBackend, ClassifyResult, MemoryBackend, RedisBackend, SharedCache, SQLiteBackend
+from resp_stand_in import RespStandIn
+
+
+class Unregistered(BaseModel):
+    value: int
+
+
+RESULT = ClassifyResult(complexity="simple", domain="marketing", needs_clarification=False, questions=[])
+
+
+@pytest.fixture
+def sqlite_backend(tmp_path):
+    return SQLiteBackend(path=str(tmp_path / "cache.sqlite3"))
+
+
+def test_sqlite_queries_run_off_the_event_loop(sqlite_backend, monkeypatch):
+    threads = []
+    set_sync = sqlite_backend._set_sync
+
+    def spy(*args):
+        threads.append(threading.current_thread())
+        return set_sync(*args)
+
+    monkeypatch.setattr(sqlite_backend, "_set_sync", spy)
+
+    async def scenario():
+        await sqlite_backend.set("k", {"a": 1}, 60)
+        value = await sqlite_backend.get("k")
+        await sqlite_backend.close()
+        return value
+
+    assert asyncio.run(scenario()) == b'{"a":1}'
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_sqlite_add_delete_clear_and_size(sqlite_backend, monkeypatch):
+    threads = []
+    count_sync = sqlite_backend._count_sync
+
+    def spy(prefix):
+        threads.append(threading.current_thread())
+        return count_sync(prefix)
+
+    monkeypatch.setattr(sqlite_backend, "_count_sync", spy)
+    monkeypatch.setattr(sqlite_backend, "SIZE_REFRESH", 0.0)
+
+    async def counted(prefix):
+        first = sqlite_backend.size(prefix)  # schedules a recount on the cache thread
+        await sqlite_backend._run(lambda: None)  # the thread is FIFO, so the count is in
+        return first, sqlite_backend.size(prefix)
+
+    async def scenario():
+        assert await sqlite_backend.add("ns:a", 1, 60)
+        assert not await sqlite_backend.add("ns:a", 2, 60)
+        await sqlite_backend.set("ns:b", 3, 60)
+        await sqlite_backend.set("other:c", 4, 60)
+        await sqlite_backend.delete("ns:b")
+        size = await counted("ns:")
+        await sqlite_backend.clear("ns:")
+        remaining = (await counted("ns:"))[1], (await counted("other:"))[1]
+        await sqlite_backend.close()
+        return size, remaining
+
+    assert asyncio.run(scenario()) == ((None, 1), (0, 1))
+    assert threads and threading.main_thread() not in threads
+
+
+def test_backend_missing_an_operation_cannot_be_created():
+    class NoClear(CacheBackend):
+        async def _get(self, key): ...
+        async def _set(self, key, value, ttl): ...
+        async def _add(self, key, value, ttl): ...
+        async def _delete(self, key): ...
+
+    with pytest.raises(TypeError, match="_clear"):
+        NoClear()
+
+
+def test_unencodable_value_is_a_dropped_write():
+    cache = SharedCache("test-unencodable", ttl=60)
+    cache.backend = MemoryBackend()
+
+    async def scenario():
+        await cache.set("k", Unregistered(value=1))
+        return await cache.get("k")
+
+    assert asyncio.run(scenario()) is None
+    assert cache.backend.stats["set"]["errors"] == 1
+
+
+def test_redis_backend_round_trip_against_stand_in():
+    async def scenario():
+        stand_in = RespStandIn()
+        server = await stand_in.start()
+        backend = RedisBackend(f"redis://127.0.0.1:{stand_in.port}/0")
+        cache = SharedCache("test-redis", ttl=60)
+        cache.backend = backend
+        try:
+            await cache.set("k", {"result": RESULT, "pair": (1, 2)})
+            value = await cache.get("k")
+            added = await cache.add("k", 1), await cache.add("fresh", 1)
+            await backend.clear(cache.prefix)
+            cleared = await cache.get("fresh")
+            return value, added, cleared
+        finally:
+            await backend.close()
+            server.close()
+            await server.wait_closed()
+
+    value, added, cleared = asyncio.run(scenario())
+    assert value == {"result": RESULT, "pair": [1, 2]}
+    assert added == (False, True)
+    assert cleared is None
+
+
+def test_redis_handshake_failures_close_the_connection(monkeypatch):
+    monkeypatch.setattr(agent_v3, "CACHE_TIMEOUT", 0.05)
+
+    async def scenario():
+        stand_in = RespStandIn(password="s3cret")
+        server = await stand_in.start()
+        slow = RespStandIn(password="s3cret", auth_delay=0.2)
+        slow_server = await slow.start()
+        backends = {
+            "wrong": RedisBackend(f"redis://:nope@127.0.0.1:{stand_in.port}/0"),
+            "timeout": RedisBackend(f"redis://:s3cret@127.0.0.1:{slow.port}/0"),
+            "right": RedisBackend(f"redis://:s3cret@127.0.0.1:{stand_in.port}/2"),
+        }
+        cache = SharedCache("test-redis-auth", ttl=60)
+        try:
+            for backend in backends.values():
+                cache.backend = backend
+                await cache.set("k", 1)
+            value = await cache.get("k")
+            await backends["right"].close()
+            await asyncio.sleep(0.3)  # the slow server notices once its AUTH reply is due
+            return backends, value, (stand_in.connections, stand_in.disconnects), (slow.connections, slow.disconnects)
+        finally:
+            for s in (server, slow_server):
+                s.close()
+                await s.wait_closed()
+
+    backends, value, served, slow = asyncio.run(scenario())
+    for name in ("wrong", "timeout"):
+        assert backends[name].stats["set"]["errors"] == 1
+        assert not backends[name]._pool[1]
+    assert value == 1
+    # Every connection was closed by the client, not left to the garbage collector
+    assert served == (2, 2) and slow == (1, 1)
@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import agent_v3
+from agent_v3 import CreditReservation, PP_DOCUMENTS
+from asgi_calls import call_app
+from openrouter_stand_in import OpenRouterStandIn, split_chunks
+
+ANALYSIS = json.dumps({
+    "project_name": "Invoicer",
+    "project_summary": "Invoicing for freelancers",
+    "problem_statement": "Freelancers lose track of unpaid invoices",
+    "target_users": ["freelancers"],
+    "core_features": ["invoices", "reminders"],
+    "mvp_scope": ["invoices"],
+    "suggested_stack": {"backend": "FastAPI"},
+    "technical_complexity": "moderate",
+    "risks": ["lock-in"],
+})
+
+
+class CreditsStub:
+    def __init__(self):
+        self.refunded: list[CreditReservation] = []
+
+    async def reserve(self, user_id, email, amount):
+        return CreditReservation(user_id, email, amount, remaining=100)
+
+    async def refund(self, reservation):
+        self.refunded.append(reservation)
+
+    def commit(self, reservation):
+        reservation.settled = True
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    # Slow enough that the whole analysis takes ~1s; the client leaves long before
+    stand_in = OpenRouterStandIn(split_chunks(ANALYSIS, 8), chunk_delay=0.03)
+    monkeypatch.setattr(
+        agent_v3, "http_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(stand_in.handler))
+    )
+    monkeypatch.setattr(agent_v3, "CREDITS", CreditsStub())
+    monkeypatch.setattr(agent_v3, "DISCONNECT_POLL_INTERVAL", 0.02)
+    monkeypatch.setattr(agent_v3, "PP_DEDUP_ENABLED", False)
+    return stand_in
+
+
+def test_disconnect_mid_stream_cancels_upstream_and_later_stages(upstream):
+    before = dict(agent_v3.RUNTIME_METRICS)
+    body = {"project_idea": "A SaaS for freelancer invoices that cancels cleanly", "user_id": "cancel-test"}
+    sent = asyncio.run(call_app("/project-protocol", body, disconnect_after=0.2))
+
+    assert sent.status == 499
+    # The analysis stream was opened, cut short and closed
+    assert upstream.count("stream_opened") == 1
+    assert upstream.count("stream_closed") == 1
+    assert upstream.count("stream_finished") == 0
+    assert upstream.count("delta") < len(split_chunks(ANALYSIS, 8))
+    # No document stage ever reached the upstream
+    assert upstream.count("completion_started") == 0
+    assert len(agent_v3.CREDITS.refunded) == 1
+
+    metrics = agent_v3.RUNTIME_METRICS
+    assert metrics["cancelled_requests"] == before["cancelled_requests"] + 1
+    assert metrics["cancelled_stages"] == before["cancelled_stages"] + 1 + len(PP_DOCUMENTS)
+    assert metrics["tokens_saved_estimate"] == before["tokens_saved_estimate"] + 1500 + 4000 * len(PP_DOCUMENTS)
@@ -0,0 +1,50 @@
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.testclient import TestClient
+
+from agent_v3 import CompressionMiddleware, merge_vary
+
+BODY = "eloquo " * 500
+
+
+@pytest.mark.parametrize("headers,expected", [
+    ([], b"Accept-Encoding"),
+    ([(b"vary", b"Origin")], b"Origin, Accept-Encoding"),
+    ([(b"vary", b"Origin, Cookie")], b"Origin, Cookie, Accept-Encoding"),
+    ([(b"Vary", b"Origin"), (b"vary", b"Cookie")], b"Origin, Cookie, Accept-Encoding"),
+    ([(b"vary", b"accept-encoding")], b"accept-encoding"),
+    ([(b"vary", b"*")], b"*"),
+])
+def test_merge_vary(headers, expected):
+    merged = merge_vary([(b"content-type", b"text/plain"), *headers], b"Accept-Encoding")
+    assert merged == [(b"content-type", b"text/plain"), (b"vary", expected)]
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    # CORS inside compression, so its Vary: Origin reaches CompressionMiddleware
+    app.add_middleware(CORSMiddleware, allow_origins=["https://eloquo.io"])
+    app.add_middleware(CompressionMiddleware)
+
+    @app.get("/doc")
+    async def doc():
+        return Response(BODY, media_type="text/plain", headers={"Vary": "Cookie"})
+
+    return TestClient(app)
+
+
+def test_compressed_response_keeps_existing_vary(client):
+    response = client.get("/doc", headers={"Accept-Encoding": "gzip", "Origin": "https://eloquo.io"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text == BODY  # decoded by httpx
+    vary = [item.strip() for item in response.headers["vary"].split(",")]
+    assert vary == ["Cookie", "Origin", "Accept-Encoding"]
+
+
+def test_uncompressed_response_is_untouched(client):
+    response = client.get("/doc", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert response.headers["vary"] == "Cookie, Origin"  # as CORS left it
+    assert response.content == BODY.encode()
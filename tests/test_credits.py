@@ -0,0 +1,239 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import agent_v3
+from agent_v3 import CreditsClient, ProjectProtocolRequest, UpstreamLedger
+
+
+class CreditsStandIn:
+    """In-memory stand-in for the Eloquo credits API (/api/agent/credits)."""
+
+    def __init__(self, balances: dict[str, int]):
+        self.balances = dict(balances)
+        self.calls: list[tuple[str, str, int]] = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/api/agent/credits"
+        assert request.headers["authorization"] == "Bearer secret"
+        body = json.loads(request.content)
+        user_id, action, amount = body["user_id"], body["action"], body["amount"]
+        self.calls.append((action, user_id, amount))
+        if user_id not in self.balances:
+            return httpx.Response(404, json={"error": "not found"})
+        if action == "reserve":
+            if self.balances[user_id] < amount:
+                return httpx.Response(402, json={"credits_remaining": self.balances[user_id]})
+            self.balances[user_id] -= amount
+        elif action == "refund":
+            self.balances[user_id] += amount
+        else:
+            return httpx.Response(400, json={"error": action})
+        return httpx.Response(200, json={"success": True, "credits_remaining": self.balances[user_id]})
+
+
+@pytest.fixture
+def api(monkeypatch):
+    stand_in = CreditsStandIn({"alice": 20, "bob": 3})
+    monkeypatch.setattr(
+        agent_v3, "http_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(stand_in.handler))
+    )
+    return stand_in
+
+
+def client(lease_size: int = 0, lease_ttl: float = 60) -> CreditsClient:
+    return CreditsClient("http://credits.test", "secret", lease_size=lease_size, lease_ttl=lease_ttl)
+
+
+def test_reserve_is_one_atomic_call(api):
+    credits = client()
+    reservation = asyncio.run(credits.reserve("alice", None, 5))
+    assert api.calls == [("reserve", "alice", 5)]
+    assert reservation.remaining == 15
+    assert api.balances["alice"] == 15
+
+
+def test_refund_returns_credits_once(api):
+    credits = client()
+
+    async def scenario():
+        reservation = await credits.reserve("alice", None, 5)
+        await credits.refund(reservation)
+        await credits.refund(reservation)
+
+    asyncio.run(scenario())
+    assert api.calls == [("reserve", "alice", 5), ("refund", "alice", 5)]
+    assert api.balances["alice"] == 20
+
+
+def test_committed_reservation_is_not_refunded(api):
+    credits = client()
+
+    async def scenario():
+        reservation = await credits.reserve("alice", None, 5)
+        credits.commit(reservation)
+        await credits.refund(reservation)
+
+    asyncio.run(scenario())
+    assert api.balances["alice"] == 15
+    assert credits.stats["commits"] == 1 and credits.stats["refunds"] == 0
+
+
+@pytest.mark.parametrize("user_id,status", [("bob", 402), ("nobody", 404)])
+def test_reserve_errors(api, user_id, status):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(client().reserve(user_id, None, 5))
+    assert error.value.status_code == status
+
+
+def test_lease_serves_later_reservations_without_a_round_trip(api):
+    credits = client(lease_size=10)
+
+    async def scenario():
+        first = await credits.reserve("alice", None, 2)
+        second = await credits.reserve("alice", None, 2)
+        await credits.refund(second)  # back into the live lease
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert api.calls == [("reserve", "alice", 10)]
+    assert first.lease is second.lease and second.lease.balance == 8
+    assert credits.stats["lease_hits"] == 1
+
+
+def test_concurrent_reservations_share_one_lease(api):
+    credits = client(lease_size=10)
+
+    async def scenario():
+        return await asyncio.gather(*(credits.reserve("alice", None, 2) for _ in range(5)))
+
+    reservations = asyncio.run(scenario())
+    assert api.calls == [("reserve", "alice", 10)]
+    assert reservations[0].lease.balance == 0
+
+
+def test_lease_falls_back_to_the_run_amount_on_402(api):
+    credits = client(lease_size=10)
+    reservation = asyncio.run(credits.reserve("bob", None, 2))
+    assert api.calls == [("reserve", "bob", 10), ("reserve", "bob", 2)]
+    assert reservation.lease is None
+    assert api.balances["bob"] == 1
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(credits.reserve("bob", None, 2))
+    assert error.value.status_code == 402
+
+
+def test_release_expired_refunds_unused_lease_balance(api):
+    credits = client(lease_size=10)
+
+    async def scenario():
+        await credits.reserve("alice", None, 2)
+        await credits.release_expired()
+        assert api.balances["alice"] == 10  # still live
+        credits._leases["alice"].expires = 0
+        await credits.release_expired()
+
+    asyncio.run(scenario())
+    assert api.calls[-1] == ("refund", "alice", 8)
+    assert api.balances["alice"] == 18
+    assert credits._leases == {}
+
+
+def test_release_everything_on_shutdown(api):
+    credits = client(lease_size=10)
+
+    async def scenario():
+        await credits.reserve("alice", None, 2)
+        await credits.release_expired(everything=True)
+
+    asyncio.run(scenario())
+    assert api.balances["alice"] == 18
+    assert credits.snapshot()["active_leases"] == 0
+
+
+def test_sweeper_waits_for_a_reservation_renewing_the_lease(api, monkeypatch):
+    credits = client(lease_size=10)
+    call = credits._call
+
+    async def slow_call(action, *args):
+        if action == "reserve":
+            await asyncio.sleep(0.05)
+        return await call(action, *args)
+
+    monkeypatch.setattr(credits, "_call", slow_call)
+
+    async def scenario():
+        await credits.reserve("alice", None, 5)  # lease of 10, 5 left
+        credits._leases["alice"].expires = 0
+        renewing = asyncio.create_task(credits.reserve("alice", None, 5))
+        await asyncio.sleep(0.01)  # reserve is waiting on the credits API
+        await credits.release_expired()
+        await renewing
+        await credits.release_expired(everything=True)
+
+    asyncio.run(scenario())
+    # Two runs of 5 were charged; every other leased credit came back
+    assert api.balances["alice"] == 10
+    assert credits._leases == {}
+
+
+def test_per_user_locks_do_not_accumulate(api):
+    api.balances.update({f"user-{i}": 10 for i in range(50)})
+    credits = client(lease_size=5)
+
+    async def scenario():
+        await asyncio.gather(*(credits.reserve(f"user-{i}", None, 1) for i in range(50)))
+        with pytest.raises(HTTPException):
+            await credits.reserve("nobody", None, 1)
+
+    asyncio.run(scenario())
+    assert credits._locks == {}
+
+
+class StubPipeline:
+    def __init__(self, run):
+        self.run = run
+
+
+def pp_request() -> ProjectProtocolRequest:
+    return ProjectProtocolRequest(project_idea="An invoicing tool for freelancers", user_id="alice")
+
+
+def test_project_protocol_refunds_a_failed_run(api, monkeypatch):
+    async def fail(state, ledger=None):
+        raise RuntimeError("upstream exploded")
+
+    monkeypatch.setattr(agent_v3, "CREDITS", client())
+    monkeypatch.setattr(agent_v3, "PROJECT_PROTOCOL_PIPELINE", StubPipeline(fail))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(agent_v3._run_project_protocol(pp_request(), UpstreamLedger({})))
+    assert error.value.status_code == 500
+    assert api.calls == [("reserve", "alice", agent_v3.PROJECT_PROTOCOL_COST),
+                         ("refund", "alice", agent_v3.PROJECT_PROTOCOL_COST)]
+    assert api.balances["alice"] == 20
+
+
+def test_project_protocol_refunds_a_cancelled_run(api, monkeypatch):
+    started = asyncio.Event()
+
+    async def hang(state, ledger=None):
+        started.set()
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(agent_v3, "CREDITS", client())
+    monkeypatch.setattr(agent_v3, "PROJECT_PROTOCOL_PIPELINE", StubPipeline(hang))
+
+    async def scenario():
+        task = asyncio.create_task(agent_v3._run_project_protocol(pp_request(), UpstreamLedger({})))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.05)  # the shielded refund finishes
+
+    asyncio.run(scenario())
+    assert api.calls[-1] == ("refund", "alice", agent_v3.PROJECT_PROTOCOL_COST)
+    assert api.balances["alice"] == 20
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import uuid
+
+import httpx
+import pytest
+
+import agent_v3
+from agent_v3 import CreditReservation, IdempotencyStore, LocalBucketTable, PP_DOCUMENTS, RateLimiter, UpstreamLedger
+from asgi_calls import call_app
+from openrouter_stand_in import OpenRouterStandIn, split_chunks
+
+ANALYSIS = json.dumps({
+    "project_name": "Invoicer",
+    "project_summary": "Invoicing for freelancers",
+    "problem_statement": "Freelancers lose track of unpaid invoices",
+    "target_users": ["freelancers"],
+    "core_features": ["invoices", "reminders"],
+    "mvp_scope": ["invoices"],
+    "suggested_stack": {"backend": "FastAPI"},
+    "technical_complexity": "moderate",
+    "risks": ["lock-in"],
+})
+
+
+class CreditsStub:
+    def __init__(self):
+        self.reserved = 0
+
+    async def reserve(self, user_id, email, amount):
+        self.reserved += 1
+        return CreditReservation(user_id, email, amount, remaining=100)
+
+    async def refund(self, reservation):
+        pass
+
+    def commit(self, reservation):
+        reservation.settled = True
+
+
+async def supabase_stub(method, path, **kwargs):
+    return httpx.Response(201, json=[{"id": uuid.uuid4().hex}])
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    stand_in = OpenRouterStandIn(split_chunks(ANALYSIS, 16), chunk_delay=0.02)
+    monkeypatch.setattr(
+        agent_v3, "http_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(stand_in.handler))
+    )
+    monkeypatch.setattr(agent_v3, "CREDITS", CreditsStub())
+    monkeypatch.setattr(agent_v3, "IDEMPOTENCY", IdempotencyStore())
+    monkeypatch.setattr(agent_v3, "RATE_LIMITER", RateLimiter(LocalBucketTable()))
+    monkeypatch.setattr(agent_v3, "DISCONNECT_POLL_INTERVAL", 0.02)
+    monkeypatch.setattr(agent_v3, "PP_DEDUP_ENABLED", False)
+    monkeypatch.setattr(agent_v3, "supabase_request", supabase_stub)
+    return stand_in
+
+
+def body() -> dict:
+    return {"project_idea": f"A SaaS for freelancer invoices {uuid.uuid4().hex}", "user_id": "idem-test"}
+
+
+def test_retry_after_a_disconnect_gets_the_same_execution(upstream):
+    request, key = body(), {"Idempotency-Key": uuid.uuid4().hex}
+
+    async def scenario():
+        first = await call_app("/project-protocol", request, key, disconnect_after=0.05)
+        retry = await call_app("/project-protocol", request, key)
+        again = await call_app("/project-protocol", request, key)
+        return first, retry, again
+
+    first, retry, again = asyncio.run(scenario())
+    assert first.status == 499
+    assert retry.status == 200 and retry.headers["idempotent-replayed"] == "true"
+    assert again.json() == retry.json()
+    assert agent_v3.IDEMPOTENCY.stats["executions"] == 1
+    assert agent_v3.CREDITS.reserved == 1
+    assert upstream.count("stream_opened") == 1
+    assert upstream.count("completion_started") == len(PP_DOCUMENTS)
+
+
+def test_abandoned_execution_is_cancelled_after_the_grace_period(upstream, monkeypatch):
+    monkeypatch.setattr(agent_v3, "IDEMPOTENCY_ABANDON_GRACE", 0.05)
+    before = agent_v3.RUNTIME_METRICS["cancelled_stages"]
+
+    async def scenario():
+        sent = await call_app("/project-protocol", body(), {"Idempotency-Key": "k"}, disconnect_after=0.05)
+        await asyncio.sleep(0.2)
+        return sent
+
+    assert asyncio.run(scenario()).status == 499
+    assert upstream.count("stream_closed") == 1 and upstream.count("completion_started") == 0
+    assert agent_v3.RUNTIME_METRICS["cancelled_stages"] > before
+    assert not agent_v3.IDEMPOTENCY.inflight
+
+
+def test_keys_are_scoped_to_the_caller(upstream):
+    request, key = body(), {"Idempotency-Key": "shared-key"}
+    other = {**request, "project_idea": request["project_idea"] + " (different)"}
+
+    async def scenario():
+        mine = await call_app("/project-protocol", request, key, client="203.0.113.10")
+        theirs = await call_app("/project-protocol", other, key, client="203.0.113.11")
+        return mine, theirs
+
+    mine, theirs = asyncio.run(scenario())
+    # Neither a conflict for the owner nor a replay of someone else's result
+    assert mine.status == theirs.status == 200
+    assert "idempotent-replayed" not in theirs.headers
+    assert agent_v3.IDEMPOTENCY.stats["executions"] == 2
+
+
+def test_retry_does_not_attach_to_a_cancelled_execution():
+    store = IdempotencyStore()
+
+    async def scenario():
+        async def run(ledger=None):
+            await asyncio.sleep(10)
+
+        async def quick(ledger=None):
+            return {"ok": True}
+
+        stale = store.start("optimize:k", "fp", run(), UpstreamLedger({}))
+        stale.task.cancel()
+        await asyncio.sleep(0)  # cancelled, but not yet released
+        assert store.inflight["optimize:k"] is stale
+        result, flight = await store.lookup("optimize:k", "fp", "k")
+        assert result is None and flight is None
+        fresh = store.start("optimize:k", "fp", quick(), UpstreamLedger({}))
+        await asyncio.sleep(0.01)  # the stale release must not drop the fresh execution
+        return fresh.task.result(), await store.results.get("optimize:k")
+
+    assert asyncio.run(scenario()) == ({"ok": True}, ["fp", {"ok": True}])
+
+
+def test_retry_does_not_attach_to_an_abandoned_execution():
+    store = IdempotencyStore()
+
+    async def scenario():
+        async def run(ledger=None):
+            await asyncio.sleep(10)
+
+        flight = store.start("optimize:k", "fp", run(), UpstreamLedger({}))
+        agent_v3._abandon(flight, "optimize")  # the grace period ran out; cancellation is under way
+        return flight.task.done(), await store.lookup("optimize:k", "fp", "k")
+
+    done, (result, flight) = asyncio.run(scenario())
+    assert not done
+    assert result is None and flight is None
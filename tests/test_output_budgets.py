@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+import agent_v3
+from agent_v3 import OutputBudgets, call_openrouter_budgeted
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    """Queue of (content, finish_reason, output_tokens); records each call's arguments."""
+    queue, calls = [], []
+
+    async def fake(model, system_prompt, user_prompt, max_tokens=2000, history=None):
+        calls.append({"user_prompt": user_prompt, "max_tokens": max_tokens, "history": history or []})
+        content, finish_reason, output_tokens = queue.pop(0)
+        return {"content": content, "finish_reason": finish_reason, "tokens": output_tokens + 10,
+                "input_tokens": 10, "output_tokens": output_tokens, "cached_tokens": 0}
+
+    monkeypatch.setattr(agent_v3, "call_openrouter_async", fake)
+    monkeypatch.setattr(agent_v3, "OUTPUT_BUDGETER", OutputBudgets())
+    return queue, calls
+
+
+def test_cut_off_document_is_continued_and_joined(replies):
+    queue, calls = replies
+    queue.extend([("# Plan\npart one ", "length", 50), ("part two.", "stop", 20)])
+    response = asyncio.run(call_openrouter_budgeted("pp_document", "simple", "pro", "m", "sys", "write"))
+    assert response["content"] == "# Plan\npart one part two."
+    assert response["output_tokens"] == 70
+    assert response["budget"]["continued"] and not response["budget"]["retried"]
+    assert calls[1]["user_prompt"] == agent_v3.OUTPUT_CONTINUE_PROMPT
+    assert calls[1]["history"][-1] == {"role": "assistant", "content": "# Plan\npart one "}
+
+
+def test_cut_off_json_is_retried_whole_at_the_ceiling(replies):
+    queue, calls = replies
+    queue.extend([('{"edits": [{"find": "a", "rep', "length", 50), ('{"edits": [], "changes": []}', "stop", 30)])
+    response = asyncio.run(call_openrouter_budgeted("refine_edits", "simple", "pro", "m", "sys", "edit"))
+    assert response["content"] == '{"edits": [], "changes": []}'
+    assert response["finish_reason"] == "stop"
+    assert response["output_tokens"] == 80  # both calls are paid for
+    assert response["budget"]["retried"] and not response["budget"]["continued"]
+    assert calls[1]["user_prompt"] == "edit" and calls[1]["history"] == []
+    assert calls[1]["max_tokens"] == OutputBudgets.ceiling("refine_edits")
+    assert list(agent_v3.OUTPUT_BUDGETER.lengths[("refine_edits", "simple", "pro")]) == [30]
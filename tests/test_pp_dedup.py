@@ -0,0 +1,68 @@
+import pytest
+
+import agent_v3
+from agent_v3 import ProjectIdeaIndex, ProjectProtocolRequest
+
+IDEA = ("A SaaS that lets freelancers create and send invoices, track payments, "
+        "send automatic reminders for overdue invoices and export reports for taxes")
+ANALYSIS = {"project_name": "Invoicer", "project_summary": "Invoices for Alice's design studio"}
+
+
+def request(user_id: str = "alice", idea: str = IDEA, tier: str = "pro", **fields) -> ProjectProtocolRequest:
+    return ProjectProtocolRequest(project_idea=idea, user_id=user_id, user_tier=tier, **fields)
+
+
+@pytest.fixture
+def index():
+    return ProjectIdeaIndex(max_entries=10)
+
+
+def remember(index: ProjectIdeaIndex, req: ProjectProtocolRequest, analysis: dict = ANALYSIS):
+    index.add(index.sketch(req), req.user_tier, analysis)
+
+
+def test_same_user_near_duplicate_is_found(index):
+    remember(index, request())
+    req = request(idea=IDEA + ", with Stripe")
+    similarity, entry = index.lookup(index.sketch(req), req.user_tier)
+    assert similarity >= agent_v3.PP_DEDUP_SEED_THRESHOLD
+    assert entry["analysis"] == ANALYSIS
+
+
+def test_analyses_are_not_shared_across_users(index):
+    remember(index, request("alice"))
+    req = request("bob")
+    assert index.lookup(index.sketch(req), req.user_tier) is None
+    assert index.stats["misses"] == 1
+
+
+def test_lower_tier_entries_are_not_reused_for_higher_tiers(index):
+    remember(index, request(tier="basic"))
+    req = request(tier="business")
+    assert index.lookup(index.sketch(req), req.user_tier) is None
+
+
+def test_scope_includes_project_type_and_tech(index):
+    remember(index, request(tech_preferences="Django"))
+    req = request(tech_preferences="Rails")
+    assert index.lookup(index.sketch(req), req.user_tier) is None
+
+
+def test_long_ideas_are_capped_before_signing(index, monkeypatch):
+    signed = []
+    original = ProjectIdeaIndex.signature
+
+    def spy(self, hashes):
+        signed.append(len(hashes))
+        return original(self, hashes)
+
+    monkeypatch.setattr(ProjectIdeaIndex, "signature", spy)
+    words = " ".join(f"feature{i} module{i % 97}" for i in range(20_000))
+    sketch = index.sketch(request(idea=words, additional_context=words))
+    assert sketch is not None
+    assert signed == [agent_v3.PP_DEDUP_MAX_SHINGLES]
+
+
+def test_idea_without_terms_has_no_sketch(index):
+    assert index.sketch(request(idea="the and of to " * 10)) is None
+    assert index.lookup(None, "pro") is None
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import uuid
+
+import httpx
+import pytest
+
+import agent_v3
+from agent_v3 import PROJECT_PROTOCOL_PIPELINE, PP_DOCUMENTS, ProjectProtocolRequest, UpstreamLedger
+from openrouter_stand_in import OpenRouterStandIn, split_chunks
+
+# Streamed in this order: everything the PRD needs first, suggested_stack
+# (which architecture and stories also wait for) last
+ANALYSIS = {
+    "project_name": "Invoicer",
+    "project_summary": "Invoicing for freelancers",
+    "problem_statement": "Freelancers lose track of unpaid invoices",
+    "target_users": ["freelancers", "small studios"],
+    "core_features": ["create invoices", "payment tracking", "overdue reminders"],
+    "mvp_scope": ["invoices", "reminders"],
+    "technical_complexity": "moderate",
+    "risks": ["payment provider lock-in"],
+    "suggested_stack": {"frontend": "Next.js", "backend": "FastAPI", "database": "Postgres"},
+}
+CHUNK_DELAY = 0.02
+
+
+@pytest.fixture
+def openrouter(monkeypatch):
+    stand_in = OpenRouterStandIn(split_chunks(json.dumps(ANALYSIS)), chunk_delay=CHUNK_DELAY, reply_delay=0.05)
+    monkeypatch.setattr(
+        agent_v3, "http_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(stand_in.handler))
+    )
+    return stand_in
+
+
+def run_pipeline(idea: str):
+    request = ProjectProtocolRequest(project_idea=idea, user_id=f"bench-{uuid.uuid4().hex}")
+    ledger = UpstreamLedger({"pp_analyze": 1500, **{name: 4000 for name in PP_DOCUMENTS}})
+    return asyncio.run(PROJECT_PROTOCOL_PIPELINE.run({"request": request, "config": agent_v3.CONFIG.current},
+                                                     ledger=ledger))
+
+
+def test_prd_starts_while_analysis_is_still_streaming(openrouter):
+    ctx = run_pipeline(f"A SaaS for freelancer invoices and payment reminders {uuid.uuid4().hex}")
+    info = ctx.stage_info
+    analysis_done_ms = info["pp_analyze"]["start_ms"] + info["pp_analyze"]["duration_ms"]
+
+    assert info["pp_analyze"]["status"] == "ok"
+    assert ctx.value("analysis")["suggested_stack"] == ANALYSIS["suggested_stack"]
+    assert all(info[name]["status"] == "ok" for name in PP_DOCUMENTS)
+    # suggested_stack takes several more deltas to stream after the PRD's last input
+    assert info["prd"]["start_ms"] < analysis_done_ms - CHUNK_DELAY * 1000
+    # The stage stops reading once the object closes, so the stream ends with stream_closed
+    assert openrouter.times("completion_started")[0] < openrouter.times("stream_closed")[0]
+    # Architecture and stories need the last field, so they start with the end of the stream
+    assert all(info[name]["start_ms"] >= info["prd"]["start_ms"] for name in ("architecture", "stories"))
+    print(f"\npp_analyze done at {analysis_done_ms}ms, prd started at {info['prd']['start_ms']}ms "
+          f"({analysis_done_ms - info['prd']['start_ms']}ms of overlap)")
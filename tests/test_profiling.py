@@ -0,0 +1,68 @@
+import asyncio
+import sys
+
+import agent_v3
+from agent_v3 import RequestProfiler, StackProfile, profiling_task_factory
+
+
+class Result:
+    def __init__(self):
+        self.metrics = {}
+
+
+def test_task_factory_is_installed_only_while_a_request_is_profiled():
+    profiler = RequestProfiler(rate=1.0)
+
+    async def work():
+        factory = asyncio.get_running_loop().get_task_factory()
+        child = asyncio.create_task(asyncio.sleep(0), name="child")
+        await child
+        return factory, child
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        idle = loop.get_task_factory()
+        result = Result()
+
+        async def endpoint():
+            result.seen = await work()
+            return result
+
+        await profiler.run("optimize", endpoint())
+        return idle, result, loop.get_task_factory()
+
+    idle, result, after = asyncio.run(scenario())
+    factory, child = result.seen
+    assert idle is None and after is None
+    assert factory is profiling_task_factory
+    assert child.get_name() == "child"
+    assert result.metrics["profile"]["name"] == "optimize"
+
+
+def test_unsampled_requests_leave_the_loop_alone():
+    async def scenario():
+        result = await RequestProfiler(rate=0).run("optimize", asyncio.sleep(0, Result()))
+        return result, asyncio.get_running_loop().get_task_factory()
+
+    result, factory = asyncio.run(scenario())
+    assert "profile" not in result.metrics and factory is None
+
+
+def test_loop_stack_is_attributed_to_the_task_running_it():
+    sampler = agent_v3.StackSampler()
+    profile = StackProfile("optimize")
+    seen = []
+
+    async def tagged():
+        await asyncio.sleep(0)
+        seen.append(sampler._running_profile(sys._getframe()))
+
+    async def scenario():
+        task = asyncio.create_task(tagged())
+        sampler.attach(task, profile)
+        await task
+        return sampler._running_profile(sys._getframe())
+
+    outside = asyncio.run(scenario())
+    assert seen == [profile] and outside is None
+    assert not sampler.task_frames  # dropped when the task finished
@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+import agent_v3
+from agent_v3 import BucketTable, LocalBucketTable, RateLimiter, enforce_rate_limit, used_tokens
+
+SECRET = "Bearer eloquo-agent-internal-key"
+
+
+def http_request(headers: dict, host: str = "203.0.113.7") -> Request:
+    return Request({
+        "type": "http",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": (host, 40000),
+    })
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    limiter = RateLimiter(LocalBucketTable())
+    monkeypatch.setattr(agent_v3, "RATE_LIMITER", limiter)
+    return limiter
+
+
+@pytest.mark.parametrize("headers,user_id,tier,expected", [
+    # Unauthenticated callers are limited by IP at the basic tier, whatever they claim
+    ({}, None, None, ("ip:203.0.113.7", "basic")),
+    ({"X-User-Id": "victim", "X-User-Tier": "business"}, None, "business", ("ip:203.0.113.7", "basic")),
+    ({}, "someone", "enterprise", ("ip:203.0.113.7", "basic")),
+    ({"X-Forwarded-For": "198.51.100.1"}, None, None, ("ip:203.0.113.7", "basic")),
+    ({"Authorization": "Bearer wrong", "X-User-Id": "u1"}, None, "pro", ("ip:203.0.113.7", "basic")),
+    # The Eloquo server speaks for its users
+    ({"Authorization": SECRET, "X-User-Id": "u1", "X-User-Tier": "business"}, None, "pro", ("u1", "business")),
+    ({"Authorization": SECRET}, "u2", "pro", ("u2", "pro")),
+    ({"Authorization": SECRET}, None, None, (None, "basic")),
+])
+def test_identity_and_tier(limiter, headers, user_id, tier, expected):
+    grant = enforce_rate_limit(http_request(headers), "optimize", tier, user_id)
+    assert (grant.user, grant.tier) == expected
+
+
+def test_bucket_table_missing_an_operation_cannot_be_created():
+    class NoStore(BucketTable):
+        def _locked(self): ...
+        def _load(self, key, burst, now): ...
+
+    with pytest.raises(TypeError, match="_store"):
+        NoStore()
+
+
+def test_forwarded_for_only_with_a_trusted_proxy(limiter, monkeypatch):
+    monkeypatch.setattr(agent_v3, "RATE_LIMIT_TRUST_PROXY", True)
+    grant = enforce_rate_limit(http_request({"X-Forwarded-For": "198.51.100.1, 10.0.0.1"}), "optimize")
+    assert grant.user == "ip:198.51.100.1"
+
+
+def test_rotating_user_headers_does_not_reset_the_bucket(limiter):
+    burst = agent_v3.RATE_LIMITS["basic"]["burst"]
+    for i in range(burst):
+        enforce_rate_limit(http_request({"X-User-Id": f"fake-{i}"}), "refine")
+    with pytest.raises(agent_v3.RateLimitExceeded):
+        enforce_rate_limit(http_request({"X-User-Id": "fake-new"}), "refine")
+
+
+@pytest.mark.parametrize("metrics,expected", [
+    (None, None),
+    ({}, None),
+    ({"total_tokens": 0}, None),
+    ({"total_tokens": 1234}, 1234),
+])
+def test_used_tokens(metrics, expected):
+    assert used_tokens(SimpleNamespace(metrics=metrics)) == expected
+
+
+def test_optimize_settles_against_stage_usage(limiter, monkeypatch):
+    async def fake_run_agent(agent, model_id, prompt):
+        if "Analyze this prompt" in prompt:
+            content = agent_v3.ClassifyResult(complexity="simple", domain="marketing",
+                                              needs_clarification=False, questions=[])
+            input_tokens, output_tokens = 200, 50
+        else:
+            content = agent_v3.GenerateResult(optimized_prompt="Write a launch email.", full_version="f",
+                                              quick_ref="q", snippet="s", improvements=[], quality_score=8.0)
+            input_tokens, output_tokens = 900, 600
+        metrics = SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens,
+                                  total_tokens=input_tokens + output_tokens)
+        return SimpleNamespace(content=content, metrics=metrics)
+
+    monkeypatch.setattr(agent_v3, "run_agent", fake_run_agent)
+    monkeypatch.setattr(agent_v3.CLASSIFY_BATCHER, "max_batch", 1)
+    settled = []
+    monkeypatch.setattr(limiter, "settle", lambda grant, actual: settled.append((grant.user, actual)))
+    client = TestClient(agent_v3.app)
+    response = client.post("/optimize", json={"prompt": "email for our launch", "user_tier": "pro"},
+                           headers={"Authorization": SECRET, "X-User-Id": "settle-test"})
+    body = response.json()
+    assert body["status"] == "success", body
+    assert body["metrics"]["total_tokens"] == 250 + 1500
+    assert body["metrics"]["stages"]["generate"]["tokens"] == 1500
+    assert body["metrics"]["total_cost"] > 0
+    assert settled == [("settle-test", 1750)]
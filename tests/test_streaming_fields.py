@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+from agent_v3 import StreamingJSONFields
+
+
+def chunked(text: str, size: int) -> list[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def feed_all(chunks: list[str]) -> tuple[StreamingJSONFields, list[str]]:
+    parser = StreamingJSONFields()
+    order = []
+    for chunk in chunks:
+        order += parser.feed(chunk)
+    return parser, order
+
+
+OBJECT = {
+    "project_name": "Invoicer",
+    "summary": 'Braces {like} [these] and "quotes" inside a string',
+    "path": "C:\\temp\\\"x\"",
+    "features": ["a", {"nested": {"deep": [1, 2, {"x": "}"}]}}, "c"],
+    "suggested_stack": {"frontend": "React", "backend": {"lang": "Python"}},
+    "score": 8.5,
+    "empty": {},
+    "flag": True,
+    "nothing": None,
+    "count": 12,
+}
+
+DOCUMENTS = [
+    ("compact", json.dumps(OBJECT, separators=(",", ":"))),
+    ("indented", json.dumps(OBJECT, indent=2)),
+    ("fenced", "Here you go:\n```json\n" + json.dumps(OBJECT, indent=2) + "\n```\nDone."),
+    ("unicode", json.dumps({**OBJECT, "summary": "naïve café ☕ \\u00e9"}, ensure_ascii=False)),
+]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 10_000])
+@pytest.mark.parametrize("name,text", DOCUMENTS, ids=[name for name, _ in DOCUMENTS])
+def test_fields_match_json_loads_for_any_chunking(name, text, size):
+    parser, order = feed_all(chunked(text, size))
+    expected = json.loads(text[text.index("{"):text.rindex("}") + 1])
+    assert parser.complete
+    assert parser.fields == expected
+    assert order == list(expected)
+
+
+def test_field_is_reported_once_its_value_is_complete():
+    parser = StreamingJSONFields()
+    assert parser.feed('{"name": "Invoi') == []
+    assert parser.feed('cer", "stack": {"a": [1, ') == ["name"]
+    assert parser.feed("2]}") == ["stack"]
+    assert parser.fields["stack"] == {"a": [1, 2]}
+    # A bare literal is only complete once a delimiter arrives
+    assert parser.feed(', "score": 8') == []
+    assert parser.feed(".5") == []
+    assert parser.feed("}") == ["score"]
+    assert parser.complete
+
+
+@pytest.mark.parametrize("tail,value", [
+    ("true}", True),
+    ("false }", False),
+    ("null\n}", None),
+    ("-1.5e3}", -1500.0),
+    ("0}", 0),
+])
+def test_bare_literal_at_end_of_object(tail, value):
+    parser, order = feed_all(chunked('{"a": "x", "last": ' + tail, 1))
+    assert order == ["a", "last"]
+    assert parser.fields["last"] == value
+
+
+@pytest.mark.parametrize("truncated,fields", [
+    ('{"a": 1, "b": "unterminated', {"a": 1}),
+    ('{"a": 1, "b": {"c": [1, 2', {"a": 1}),
+    ('{"a": "x", "b": tr', {"a": "x"}),
+    ('{"a": "x", "b"', {"a": "x"}),
+    ('```json\n{"a', {}),
+    ("no json here", {}),
+])
+def test_truncated_stream_keeps_only_complete_fields(truncated, fields):
+    parser, _ = feed_all(chunked(truncated, 3))
+    assert not parser.complete
+    assert parser.fields == fields
+
+
+def test_invalid_value_is_skipped_not_raised():
+    parser, order = feed_all(['{"a": tru, "b": 2}'])
+    assert order == ["b"]
+    assert parser.fields == {"b": 2}
+    assert parser.complete
+
+
+def test_text_after_the_object_is_ignored():
+    parser, order = feed_all(['{"a": 1}', ' {"b": 2}'])
+    assert parser.complete
+    assert parser.fields == {"a": 1}
+    assert order == ["a"]
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+import agent_v3
+from agent_v3 import (ClassifyResult, ProjectAnalysis, RefineEditsOutput, RefineOutput, StructuredOutputError,
+                      parse_or_repair, parse_structured)
+
+# Captured-style malformed model outputs, named <schema>.<case>.txt; ".repair"
+# cases can't be recovered locally and need the repair call
+CORPUS = Path(__file__).parent / "data" / "malformed"
+SCHEMAS = {
+    "project_analysis": ProjectAnalysis,
+    "refine": RefineOutput,
+    "refine_edits": RefineEditsOutput,
+    "classify": ClassifyResult,
+}
+# What the repair model sends back for each schema
+REPAIRED = {
+    "project_analysis": ProjectAnalysis(
+        project_name="P", project_summary="S", problem_statement="", target_users=[], core_features=[],
+        mvp_scope=[], suggested_stack={}, technical_complexity="moderate", risks=[],
+    ).model_dump_json(),
+    "refine": '{"refined_prompt": "P", "changes": []}',
+    "refine_edits": '{"edits": [{"op": "delete", "find": "x"}], "changes": []}',
+    "classify": '{"complexity": "moderate", "domain": "coding", "needs_clarification": false, "questions": []}',
+}
+SAMPLES = sorted(CORPUS.glob("*.txt"))
+ROUNDS = 50
+
+
+def schema_name(path: Path) -> str:
+    return path.name.split(".", 1)[0]
+
+
+def needs_repair(path: Path) -> bool:
+    return ".repair." in path.name
+
+
+@pytest.mark.parametrize("path", SAMPLES, ids=lambda path: path.stem)
+def test_corpus_sample(path, monkeypatch):
+    schema = SCHEMAS[schema_name(path)]
+    text = path.read_text()
+    calls = []
+
+    async def fake_call(model, system_prompt, user_prompt, max_tokens=2000, history=None):
+        calls.append(user_prompt)
+        return {"content": REPAIRED[schema_name(path)], "tokens": 10}
+
+    monkeypatch.setattr(agent_v3, "call_openrouter_async", fake_call)
+    if needs_repair(path):
+        with pytest.raises(StructuredOutputError):
+            parse_structured(text, schema)
+    assert isinstance(asyncio.run(parse_or_repair(text, schema)), schema)
+    assert len(calls) == needs_repair(path)
+
+
+def test_corpus_local_recovery_rate():
+    """Share of the corpus recovered without a model call, and the time it takes per sample."""
+    recovered = 0
+    elapsed = 0.0
+    for path in SAMPLES:
+        text, schema = path.read_text(), SCHEMAS[schema_name(path)]
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            try:
+                parse_structured(text, schema)
+                ok = True
+            except StructuredOutputError:
+                ok = False
+        elapsed += time.perf_counter() - start
+        recovered += ok
+    expected = sum(not needs_repair(path) for path in SAMPLES)
+    per_sample_us = elapsed / (ROUNDS * len(SAMPLES)) * 1e6
+    print(f"\n{recovered}/{len(SAMPLES)} samples recovered locally "
+          f"({100 * recovered / len(SAMPLES):.0f}%), {per_sample_us:.0f}us per sample; "
+          f"{len(SAMPLES) - recovered} need the repair call")
+    assert recovered == expected
+    assert per_sample_us < 5000
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+from pydantic import BaseModel
+
+import agent_v3
+from agent_v3 import StructuredOutputError, extract_json, parse_structured, parse_or_repair
+
+
+class Analysis(BaseModel):
+    name: str
+    features: list[str]
+    score: float = 0
+
+
+@pytest.mark.parametrize("text,expected", [
+    ('{"a": 1}', {"a": 1}),
+    ("[1, 2, 3]", [1, 2, 3]),
+    ('```json\n{"a": 1}\n```', {"a": 1}),
+    ('Sure! Here it is:\n```json\n{"a": [1, 2]}\n```\nLet me know.', {"a": [1, 2]}),
+    # Prose with brackets before the fence is skipped
+    ('Steps [1] and {2}:\n```json\n{"a": 1}\n```', {"a": 1}),
+    ('The result is {"a": {"b": {"c": null}}} as requested.', {"a": {"b": {"c": None}}}),
+    ('{"a": "braces } ] { [ inside"}', {"a": "braces } ] { [ inside"}),
+    ('{"a": "escaped \\" quote } here", "b": "\\\\"}', {"a": 'escaped " quote } here', "b": "\\"}),
+    ('{"a": [1, 2, ], "b": {"c": 3,},}', {"a": [1, 2], "b": {"c": 3}}),
+    ('{"a": 1}\n{"b": 2}', {"a": 1}),
+    ('{"a": "naïve ☕"}', {"a": "naïve ☕"}),
+])
+def test_extracts_complete_json(text, expected):
+    assert extract_json(text) == expected
+
+
+@pytest.mark.parametrize("text,expected", [
+    ('{"a": 1, "b": "cut off mid', {"a": 1, "b": "cut off mid"}),
+    ('{"a": 1, "b": [1, 2', {"a": 1, "b": [1, 2]}),
+    ('{"a": 1, "b": {"c": "x", "d":', {"a": 1, "b": {"c": "x", "d": None}}),
+    ('{"a": 1, "b":', {"a": 1, "b": None}),
+    ('{"a": 1,', {"a": 1}),
+    ('{"a": "x", "b": tr', {"a": "x"}),
+    ('{"a": "ends with escape \\', {"a": "ends with escape "}),
+    ('```json\n{"items": [{"n": 1}, {"n": 2}, {"n"', {"items": [{"n": 1}, {"n": 2}]}),
+    # A mismatched closer ends the scan; what came before it is kept
+    ('{"a": 1, "b": [2}', {"a": 1, "b": [2]}),
+])
+def test_repairs_truncated_json(text, expected):
+    assert extract_json(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    None,
+    "no json at all",
+    '{"a": undefined}',
+    "{'a': 1}",
+])
+def test_unrecoverable_output_raises(text):
+    with pytest.raises(StructuredOutputError):
+        extract_json(text)
+
+
+def test_parse_structured_validates_against_schema():
+    parsed = parse_structured('```json\n{"name": "X", "features": ["a"], "score": 7}\n```', Analysis)
+    assert parsed == Analysis(name="X", features=["a"], score=7)
+    with pytest.raises(StructuredOutputError, match="Analysis"):
+        parse_structured('{"name": "X"}', Analysis)
+
+
+@pytest.fixture
+def repair_calls(monkeypatch):
+    calls = []
+    replies = []
+
+    async def fake_call(model, system_prompt, user_prompt, max_tokens=2000, history=None):
+        calls.append({"model": model, "user_prompt": user_prompt, "max_tokens": max_tokens})
+        return {"content": replies.pop(0), "tokens": 10}
+
+    monkeypatch.setattr(agent_v3, "call_openrouter_async", fake_call)
+    return calls, replies
+
+
+def test_parse_or_repair_skips_repair_for_valid_output(repair_calls):
+    calls, _ = repair_calls
+    parsed = asyncio.run(parse_or_repair('{"name": "X", "features": []}', Analysis))
+    assert parsed.name == "X"
+    assert calls == []
+
+
+def test_parse_or_repair_reprompts_once_with_schema(repair_calls):
+    calls, replies = repair_calls
+    replies.append('```json\n{"name": "X", "features": ["a", "b"]}\n```')
+    parsed = asyncio.run(parse_or_repair('{"name": "X", "features": "a, b"}', Analysis))
+    assert parsed.features == ["a", "b"]
+    assert len(calls) == 1
+    assert calls[0]["model"] == agent_v3.JSON_REPAIR_MODEL
+    assert '"features"' in calls[0]["user_prompt"] and "a, b" in calls[0]["user_prompt"]
+
+
+def test_parse_or_repair_raises_when_repair_also_fails(repair_calls):
+    calls, replies = repair_calls
+    replies.append("I cannot help with that.")
+    with pytest.raises(StructuredOutputError):
+        asyncio.run(parse_or_repair("nothing structured", Analysis))
+    assert len(calls) == 1